@@ -1,9 +1,8 @@
 from types import SimpleNamespace
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 from bpmn_types import *
-from pprint import pprint
 from copy import deepcopy
-from collections import defaultdict, deque
+from collections import ChainMap, defaultdict, deque
 from functools import partial
 import asyncio
 import db_connector
@@ -11,15 +10,68 @@ from datetime import datetime
 import os
 from uuid import uuid4
 import env
+import weakref
+
+try:
+    # Compressed bitmaps keep search results small and intersect in C
+    from pyroaring import BitMap as PostingSet
+except ImportError:
+    PostingSet = set
+
+# Every instance of every model by id, so lookups skip the model level.
+# Held weakly: finished instances are dropped and restored from the DB
+all_instances = weakref.WeakValueDictionary()
+# Strong references to the tasks of running instances
+running_tasks = set()
+# Dense integer ids for the search index, position -> instance id, and back.
+# Kept after an instance is collected so search can still find and restore it
+instance_ids = []
+index_ids = {}
+# Search index: variable name -> {index id: lowercased value} for string
+# values, with each name lowercased once for matching
+variables_index = defaultdict(dict)
+variable_names_lower = {}
+
+_PROCESS_TAG = f"{{{NS['bpmn']}}}process"
+
+
+def search_instances(queries):
+    # Ids of the instances matching every (name, value) query, both lowercased.
+    # A query matches a string variable whose name and value contain them
+
+    # Most selective term first, estimated by how many values it would scan
+    terms = []
+    for att, value in queries:
+        names = [
+            key for key in variables_index if key and att in variable_names_lower[key]
+        ]
+        estimate = sum(len(variables_index[key]) for key in names)
+        terms.append((estimate, names, value))
+    terms.sort(key=lambda term: term[0])
+
+    ids = None
+    for _, names, value in terms:
+        matches = PostingSet()
+        for key in names:
+            postings = variables_index[key]
+            if ids is not None and len(ids) < len(postings):
+                # Probe only the instances that matched every term so far
+                matches.update(i for i in ids if i in postings and value in postings[i])
+            else:
+                matches.update(
+                    i for i, variable in postings.items() if value in variable
+                )
+        ids = matches if ids is None else ids & matches
+        if not ids:
+            # No instance can match the remaining terms either
+            return []
 
-instance_models = {}
-
-
-def get_model_for_instance(iid):
-    return instance_models.get(iid, None)
+    return [instance_ids[i] for i in ids]
 
 
 class UserFormMessage:
+    __slots__ = ("task_id", "form_data")
+
     def __init__(self, task_id, form_data={}):
         self.task_id = task_id
         self.form_data = form_data
@@ -30,21 +82,63 @@ class BpmnModel:
         self.pending = []
         self.elements = {}
         self.flow = defaultdict(list)
-        self.instances = {}
+        # Ids of every instance created or restored, outliving the instances
+        self.instance_ids = {}
         self.process_elements = {}
         self.process_pending = defaultdict(list)
         self.main_collaboration_process = None
         self.model_path = model_path
         self.subprocesses = {}
         self.main_process = SimpleNamespace()
-
-        model_tree = ET.parse(os.path.join("models", self.model_path))
-        model_root = model_tree.getroot()
-        processes = model_root.findall("bpmn:process", NS)
-        for process in processes:
-            p = BPMN_MAPPINGS["bpmn:process"]()
-            p.parse(process)
-            self.process_elements[p._id] = {}
+        self.static_json = None
+
+        processes = []
+        # Stream the document: every mapped element is parsed as soon as its
+        # end tag is seen and then dropped, so only the current subtree and
+        # the unmapped process children (lanes, extensions...) stay in memory
+        for _, element in ET.iterparse(
+            os.path.join("models", self.model_path),
+            events=("end",),
+            remove_blank_text=True,
+            remove_comments=True,
+            huge_tree=False,
+        ):
+            parent = element.getparent()
+            if parent is None:
+                break
+            _type = BPMN_MAPPINGS_QN.get(element.tag)
+            if _type is not None and parent.tag == _PROCESS_TAG:
+                # Parse all elements in the process
+                process_id = parent.attrib["id"]
+                t = _type()
+                t.parse(element)
+                if isinstance(t, CallActivity):
+                    self.subprocesses[t.called_element] = t.deployment
+                if isinstance(t, SequenceFlow):
+                    self.flow[t.source].append(t)
+                if isinstance(t, StartEvent):
+                    self.pending.append(t)
+                    self.process_pending[process_id].append(t)
+                self.elements[t._id] = t
+                self.process_elements.setdefault(process_id, {})[t._id] = t
+                element.clear(keep_tail=True)
+                # Drop already parsed siblings, keep the ones Process.parse needs
+                while (previous := element.getprevious()) is not None and (
+                    previous.tag in BPMN_MAPPINGS_QN
+                ):
+                    parent.remove(previous)
+            elif parent.getparent() is None:
+                # Top level element (process, collaboration, diagram) is done
+                if element.tag == _PROCESS_TAG:
+                    p = _type()
+                    p.parse(element)
+                    processes.append(p)
+                    self.process_elements.setdefault(p._id, {})
+                element.clear(keep_tail=True)
+                while element.getprevious() is not None:
+                    del parent[0]
+
+        for p in processes:
             # Check for Collaboration
             if len(processes) > 1 and p.is_main_in_collaboration:
                 self.main_collaboration_process = p._id
@@ -53,23 +147,10 @@ class BpmnModel:
             else:
                 self.main_process.name = p.name
                 self.main_process.id = p._id
-            # Parse all elements in the process
-            for tag, _type in BPMN_MAPPINGS.items():
-                for e in process.findall(f"{tag}", NS):
-                    t = _type()
-                    t.parse(e)
-                    if isinstance(t, CallActivity):
-                        self.subprocesses[t.called_element] = t.deployment
-                    if isinstance(t, SequenceFlow):
-                        self.flow[t.source].append(t)
-                    if isinstance(t, ExclusiveGateway):
-                        if t.default:
-                            self.elements[t.default].default = True
-                    if isinstance(t, StartEvent):
-                        self.pending.append(t)
-                        self.process_pending[p._id].append(t)
-                    self.elements[t._id] = t
-                    self.process_elements[p._id][t._id] = t
+        # Gateways can precede their default flow in the document
+        for t in self.elements.values():
+            if isinstance(t, ExclusiveGateway) and t.default:
+                self.elements[t.default].default = True
         # Check if there is single deployement subprocess
         for k, v in self.subprocesses.items():
             if v:
@@ -77,14 +158,18 @@ class BpmnModel:
                 break
 
     def to_json(self):
-        return {
-            "model_path": self.model_path,
-            "main_process": self.main_process.__dict__,
-            "tasks": [
-                x.to_json() for x in self.elements.values() if isinstance(x, UserTask)
-            ],
-            "instances": [i._id for i in self.instances.values()],
-        }
+        # Everything but the instances is fixed once the model is parsed
+        if self.static_json is None:
+            self.static_json = {
+                "model_path": self.model_path,
+                "main_process": self.main_process.__dict__,
+                "tasks": [
+                    x.to_json()
+                    for x in self.elements.values()
+                    if isinstance(x, UserTask)
+                ],
+            }
+        return {**self.static_json, "instances": list(self.instance_ids)}
 
     async def create_instance(self, _id, variables, process=None):
         queue = asyncio.Queue()
@@ -98,7 +183,7 @@ class BpmnModel:
         instance = BpmnInstance(
             _id, model=self, variables=variables, in_queue=queue, process=process
         )
-        self.instances[_id] = instance
+        self.instance_ids[_id] = None
         return instance
 
     # Takes model_path needed for deployed subprocess
@@ -122,7 +207,12 @@ class BpmnModel:
 
 class BpmnInstance:
     def __init__(self, _id, model, variables, in_queue, process):
-        instance_models[_id] = model
+        all_instances[_id] = self
+        # A restored instance takes back the index id it had before
+        self.index_id = index_ids.get(_id)
+        if self.index_id is None:
+            self.index_id = index_ids[_id] = len(instance_ids)
+            instance_ids.append(_id)
         self._id = _id
         self.model = model
         self.variables = deepcopy(variables)
@@ -130,6 +220,7 @@ class BpmnInstance:
         self.state = "initialized"
         self.pending = deepcopy(self.model.process_pending[process])
         self.process = process
+        self.index_variables()
 
     def to_json(self):
         return {
@@ -141,30 +232,49 @@ class BpmnInstance:
             "env": env.SYSTEM_VARS,
         }
 
+    def index_variables(self):
+        for key, value in self.variables.items():
+            if isinstance(value, str):
+                if key not in variable_names_lower:
+                    variable_names_lower[key] = key.lower()
+                variables_index[key][self.index_id] = value.lower()
+            elif key in variables_index:
+                variables_index[key].pop(self.index_id, None)
+
+    def start(self):
+        # The loop only keeps weak references to tasks, and all_instances
+        # does not keep the instance alive, so hold the task until it ends
+        task = asyncio.create_task(self.run())
+        running_tasks.add(task)
+        task.add_done_callback(running_tasks.discard)
+        return task
+
     @classmethod
-    def check_condition(cls, state, condition, log):
-        log(f"\t- checking variables={state} with {condition}... ")
+    def check_condition(cls, state, sequence, log):
+        log(f"\t- checking variables={state} with {sequence.condition}... ")
         ok = False
-        if condition:
-            key = condition.partition(":")[0]
-            value = condition.partition(":")[2]
+        if sequence.parsed_condition:
+            key, value = sequence.parsed_condition
             if key in state and state[key] == value:
                 ok = True
         log("\t  DONE: Result is", ok)
         return ok
 
     async def run_from_log(self, log):
+        last = None
         for l in log:
             if l.get("activity_id") in self.model.elements:
-                pending_elements_list = []
-                for p in l.get("pending"):
-                    pending_elements_list.append(self.model.elements[p])
-                self.pending = pending_elements_list
-                self.variables = {**l.get("activity_variables"), **self.variables}
+                last = l
+                # Values already set win over the ones logged later
+                for key, value in l.get("activity_variables").items():
+                    self.variables.setdefault(key, value)
+        if last is not None:
+            self.pending = [self.model.elements[p] for p in last.get("pending")]
+        self.index_variables()
         return self
 
     async def run_subprocess(self, process_id):
-        new_subproces_instance_id = str(uuid4())
+        new_subproces_instance_id = uuid4().hex
         if not self.model.subprocesses[process_id]:
             new_subprocess_instance = await self.model.create_instance(
                 new_subproces_instance_id, {}, process_id
@@ -178,6 +288,33 @@ class BpmnInstance:
             finished_subprocess = await new_subproces_instance.run()
         return True
 
+    def can_prefetch(self, task):
+        # A task may only run ahead when no other pending element can set a
+        # variable its request reads, so it renders the same inputs as it
+        # would have when its turn came
+        reads = task.read_variables()
+        return not any(
+            reads.intersection(p.written_variables())
+            for p in self.pending
+            if p is not task
+        )
+
+    async def run_service_tasks(self, tasks):
+        # Connector calls are I/O bound, so sibling tasks fire together. Each
+        # one writes its outputs into its own layer, which run() applies to
+        # the instance variables once the task's turn comes. A failed task
+        # keeps its exception instead, the siblings that succeeded still get
+        # applied and logged before run() raises it
+        layers = [ChainMap({}, self.variables) for _ in tasks]
+        results = await asyncio.gather(
+            *(task.run(layer, self._id) for task, layer in zip(tasks, layers)),
+            return_exceptions=True,
+        )
+        return {
+            task._id: result if isinstance(result, BaseException) else layer.maps[0]
+            for task, layer, result in zip(tasks, layers, results)
+        }
+
     async def run(self):
 
         self.state = "running"
@@ -188,8 +325,11 @@ class BpmnInstance:
         in_queue = self.in_queue
         # Take only elements of running process
         elements = deepcopy(self.model.process_elements[self.process])
-        flow = deepcopy(self.model.flow)
+        # Sequence flows are never mutated, no need to copy them
+        flow = self.model.flow
         queue = deque()
+        # Outputs of service tasks that already ran concurrently
+        prefetched = {}
 
         while len(self.pending) > 0:
 
@@ -208,25 +348,43 @@ class BpmnInstance:
             # Helper current dictionary
             current_and_variables_dict = {}
 
+            # Parallel branches waiting on service tasks, run them together
+            # unless the instance may end before reaching them or one of them
+            # already failed
+            failed = any(isinstance(r, BaseException) for r in prefetched.values())
+            if not failed and not any(isinstance(p, EndEvent) for p in self.pending):
+                service_tasks = [
+                    p
+                    for p in self.pending
+                    if isinstance(p, ServiceTask)
+                    and p._id not in prefetched
+                    and self.can_prefetch(p)
+                ]
+                if len(service_tasks) > 1:
+                    prefetched.update(await self.run_service_tasks(service_tasks))
+
             for idx, current in enumerate(self.pending):
-                # Helper variables dict
-                before_variables = deepcopy(self.variables)
+                # Only the keys are needed to find variables set by current
+                before_variables = set(self.variables)
 
                 if isinstance(current, StartEvent):
                     # Helper variables for DB insert
                     new_variables = {
                         k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
+                        for k in set(self.variables) - before_variables
                     }
                     current_and_variables_dict[current._id] = new_variables
                     # Create new running instance
-                    db_connector.add_running_instance(instance_id=self._id)
+                    await db_connector.run_async(
+                        db_connector.add_running_instance, instance_id=self._id
+                    )
 
                 if isinstance(current, EndEvent):
                     exit = True
                     del self.pending[idx]
                     # Add EndEvent to DB
-                    db_connector.add_event(
+                    await db_connector.run_async(
+                        db_connector.add_event,
                         model_name=self.model.model_path,
                         instance_id=self._id,
                         activity_id=current._id,
@@ -251,17 +409,30 @@ class BpmnInstance:
                         # Helper variables for DB insert
                         new_variables = {
                             k: self.variables[k]
-                            for k in set(self.variables) - set(before_variables)
+                            for k in set(self.variables) - before_variables
                         }
                         current_and_variables_dict[current._id] = new_variables
 
                 elif isinstance(current, ServiceTask):
+                    result = prefetched.get(current._id)
+                    if isinstance(result, BaseException):
+                        if not all(
+                            isinstance(r, BaseException) for r in prefetched.values()
+                        ):
+                            # Log the siblings that succeeded first
+                            continue
+                        log("DOING:", current)
+                        raise prefetched.pop(current._id)
                     log("DOING:", current)
-                    can_continue = await current.run(self.variables, _id)
+                    if current._id in prefetched:
+                        self.variables.update(prefetched.pop(current._id))
+                        can_continue = True
+                    else:
+                        can_continue = await current.run(self.variables, _id)
                     # Helper variables for DB insert
                     new_variables = {
                         k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
+                        for k in set(self.variables) - before_variables
                     }
                     current_and_variables_dict[current._id] = new_variables
 
@@ -271,7 +442,7 @@ class BpmnInstance:
                     # Helper variables for DB insert
                     new_variables = {
                         k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
+                        for k in set(self.variables) - before_variables
                     }
                     current_and_variables_dict[current._id] = new_variables
 
@@ -282,7 +453,7 @@ class BpmnInstance:
                     # Helper variables for DB insert
                     new_variables = {
                         k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
+                        for k in set(self.variables) - before_variables
                     }
                     current_and_variables_dict[current._id] = new_variables
 
@@ -293,7 +464,7 @@ class BpmnInstance:
                     # Helper variables for DB insert
                     new_variables = {
                         k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
+                        for k in set(self.variables) - before_variables
                     }
                     current_and_variables_dict[current._id] = new_variables
 
@@ -316,9 +487,7 @@ class BpmnInstance:
                             continue
 
                         if sequence.condition:
-                            if self.check_condition(
-                                self.variables, sequence.condition, log
-                            ):
+                            if self.check_condition(self.variables, sequence, log):
                                 next_tasks.append(elements[sequence.target])
                         else:
                             next_tasks.append(elements[sequence.target])
@@ -338,10 +507,14 @@ class BpmnInstance:
                 log("Waiting for user...", self.pending)
                 queue.append(await in_queue.get())
 
+            if current_and_variables_dict:
+                self.index_variables()
+
             # Insert finished events into DB
             for c in current_and_variables_dict:
                 # Add each current into DB
-                db_connector.add_event(
+                await db_connector.run_async(
+                    db_connector.add_event,
                     model_name=self.model.model_path,
                     instance_id=self._id,
                     activity_id=c,
@@ -354,5 +527,5 @@ class BpmnInstance:
         self.state = "finished"
         self.pending = []
         # Running instance finished
-        db_connector.finish_running_instance(self._id)
+        await db_connector.run_async(db_connector.finish_running_instance, self._id)
         return self.variables
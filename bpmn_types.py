@@ -1,15 +1,80 @@
-import requests
-import os
+import aiohttp
 import env
-from utils.common import parse_expression
+from lxml import etree as ET
+from utils.common import compile_expression, parse_expression
 
 NS = {
     "bpmn": "http://www.omg.org/spec/BPMN/20100524/MODEL",
     "camunda": "http://camunda.org/schema/1.0/bpmn",
 }
 
+
+def _xpath(path):
+    return ET.XPath(path, namespaces=NS)
+
+
+def _qname(tag):
+    # "bpmn:userTask" -> "{http://www.omg.org/spec/BPMN/20100524/MODEL}userTask"
+    prefix, _, local = tag.partition(":")
+    return f"{{{NS[prefix]}}}{local}"
+
+
+# Compiled once at import instead of re-tokenized on every parse() call
+_XP_EXT = _xpath("bpmn:extensionElements")
+_XP_EXT_ALL = _xpath(".//bpmn:extensionElements")
+_XP_PROP = _xpath(".//camunda:property")
+_XP_CONDITION = _xpath("bpmn:conditionExpression")
+_XP_DOCUMENTATION = _xpath(".//bpmn:documentation")
+_XP_FORMFIELDS = _xpath(".//camunda:formField")
+_XP_CONSTRAINT = _xpath(".//camunda:constraint")
+_XP_IO_VALUE = _xpath("camunda:list | camunda:map | camunda:script")
+_XP_INCOMING = _xpath("bpmn:incoming")
+_XP_OUTGOING = _xpath("bpmn:outgoing")
+
+_CAMUNDA_INPUT_OUTPUT = _qname("camunda:inputOutput")
+_CAMUNDA_INPUT_PARAMETER = _qname("camunda:inputParameter")
+_CAMUNDA_OUTPUT_PARAMETER = _qname("camunda:outputParameter")
+_CAMUNDA_CONNECTOR = _qname("camunda:connector")
+_CAMUNDA_CONNECTOR_ID = _qname("camunda:connectorId")
+_CAMUNDA_LIST = _qname("camunda:list")
+_CAMUNDA_MAP = _qname("camunda:map")
+_CAMUNDA_CALLED_ELEMENT_BINDING = _qname("camunda:calledElementBinding")
+
 BPMN_MAPPINGS = {}
 
+_HTTP_SESSION = None
+# Bound connector calls so a stuck endpoint cannot hang an instance forever
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+_OK_STATUSES = frozenset({200, 201, 204})
+
+_HTTP_METHODS = {
+    "GET": aiohttp.ClientSession.get,
+    "POST": aiohttp.ClientSession.post,
+    "PATCH": aiohttp.ClientSession.patch,
+}
+
+
+def set_http_session(session):
+    global _HTTP_SESSION
+    _HTTP_SESSION = session
+
+
+def get_http_session():
+    # Created lazily when the engine runs without the server, eg. example.py
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        _HTTP_SESSION = aiohttp.ClientSession(timeout=HTTP_TIMEOUT)
+    return _HTTP_SESSION
+
+
+async def close_http_session():
+    # For callers without the server, which closes its own session
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None and not _HTTP_SESSION.closed:
+        await _HTTP_SESSION.close()
+    _HTTP_SESSION = None
+
 
 def bpmn_tag(tag):
     def wrap(object):
@@ -21,6 +86,8 @@ def bpmn_tag(tag):
 
 
 class BpmnObject(object):
+    __slots__ = ("_id", "name")
+
     def __repr__(self):
         return f"{type(self).__name__}({self.name or self._id})"
 
@@ -32,14 +99,20 @@ class BpmnObject(object):
 
     def parse(self, element):
         self._id = element.attrib["id"]
-        self.name = element.attrib["name"] if "name" in element.attrib else None
+        self.name = element.get("name")
 
     def run(self):
         return True
 
+    def written_variables(self):
+        # Variables run() can set on the instance
+        return ()
+
 
 @bpmn_tag("bpmn:process")
 class Process(BpmnObject):
+    __slots__ = ("is_main_in_collaboration",)
+
     def __init__(self):
         self.is_main_in_collaboration = None
         self.name = None
@@ -48,9 +121,8 @@ class Process(BpmnObject):
         super(Process, self).parse(element)
         # Extensions should exists only if it's Collaboration diagram
         self.name = element.attrib["name"]
-        if element.find(".bpmn:extensionElements", NS):
-            ext = element.find(".bpmn:extensionElements", NS)
-            for p in ext.findall(".//camunda:property", NS):
+        for ext in _XP_EXT(element):
+            for p in _XP_PROP(ext):
                 # Find property is_main
                 if p.attrib["name"] == "is_main" and p.attrib["value"] == "True":
                     self.is_main_in_collaboration = True
@@ -58,17 +130,24 @@ class Process(BpmnObject):
 
 @bpmn_tag("bpmn:sequenceFlow")
 class SequenceFlow(BpmnObject):
+    __slots__ = ("source", "target", "condition", "parsed_condition", "default")
+
     def __init__(self):
         self.source = None
         self.target = None
         self.condition = None
+        self.parsed_condition = None
 
     def parse(self, element):
         super(SequenceFlow, self).parse(element)
         self.source = element.attrib["sourceRef"]
         self.target = element.attrib["targetRef"]
-        for c in element.findall("bpmn:conditionExpression", NS):
+        for c in _XP_CONDITION(element):
             self.condition = c.text
+        if self.condition:
+            # Split "key:value" once here instead of on every check
+            key, _, value = self.condition.partition(":")
+            self.parsed_condition = (key, value)
 
     def __repr__(self):
         condition = f" w. {len(self.condition)} con. " if self.condition else ""
@@ -79,6 +158,8 @@ class SequenceFlow(BpmnObject):
 
 @bpmn_tag("bpmn:task")
 class Task(BpmnObject):
+    __slots__ = ()
+
     def parse(self, element):
         super(Task, self).parse(element)
 
@@ -88,40 +169,39 @@ class Task(BpmnObject):
 
 @bpmn_tag("bpmn:manualTask")
 class ManualTask(Task):
-    pass
+    __slots__ = ()
 
 
 @bpmn_tag("bpmn:userTask")
 class UserTask(Task):
+    __slots__ = ("form_fields", "documentation")
+
     def __init__(self):
         self.form_fields = {}
         self.documentation = ""
 
     def parse(self, element):
         super(UserTask, self).parse(element)
-        for f in element.findall(".//camunda:formField", NS):
+        for f in _XP_FORMFIELDS(element):
             form_field_properties_dict = {}
             form_field_validations_dict = {}
 
-            self.form_fields[f.attrib["id"]] = {}
-            self.form_fields[f.attrib["id"]]["type"] = f.attrib["type"]
-            if "label" in f.attrib:
-                self.form_fields[f.attrib["id"]]["label"] = f.attrib["label"]
-            else:
-                self.form_fields[f.attrib["id"]]["label"] = ""
+            form_field = self.form_fields[f.attrib["id"]] = {}
+            form_field["type"] = f.attrib["type"]
+            form_field["label"] = f.get("label", "")
 
-            for p in f.findall(".//camunda:property", NS):
+            for p in _XP_PROP(f):
                 form_field_properties_dict[p.attrib["id"]] = parse_expression(
                     p.attrib["value"], env.SYSTEM_VARS | env.DS
                 )
 
-            for v in f.findall(".//camunda:constraint", NS):
+            for v in _XP_CONSTRAINT(f):
                 form_field_validations_dict[v.attrib["name"]] = v.attrib["config"]
 
-            self.form_fields[f.attrib["id"]]["validation"] = form_field_validations_dict
-            self.form_fields[f.attrib["id"]]["properties"] = form_field_properties_dict
+            form_field["validation"] = form_field_validations_dict
+            form_field["properties"] = form_field_properties_dict
 
-        for d in element.findall(".//bpmn:documentation", NS):
+        for d in _XP_DOCUMENTATION(element):
             self.documentation = d.text
 
     def run(self, state, user_input):
@@ -130,6 +210,9 @@ class UserTask(Task):
                 state[k] = v
         return True
 
+    def written_variables(self):
+        return self.form_fields.keys()
+
     def get_info(self):
         info = super(UserTask, self).get_info()
         return {
@@ -139,8 +222,93 @@ class UserTask(Task):
         }
 
 
+class _CompiledCall:
+    # Connector request resolved in ServiceTask.parse, invoke() only renders
+    # the precompiled templates and sends the request
+    __slots__ = (
+        "call_function",
+        "url",
+        "parameters",
+        "inputs",
+        "output_variables",
+        "read_variables",
+    )
+
+    def __init__(self, call_function, url, parameters, inputs, output_variables):
+        self.call_function = call_function
+        self.url = url
+        self.parameters = parameters
+        self.inputs = inputs
+        self.output_variables = output_variables
+
+        # Every variable rendering the request can read
+        templates = [url, *(template for _, template in parameters)]
+        for _, kind, template in inputs:
+            if kind is str:
+                templates.append(template)
+            elif kind is list:
+                templates.extend(template)
+            elif kind is dict:
+                templates.extend(template.values())
+        self.read_variables = frozenset().union(
+            *(template.variables for template in templates if template)
+        )
+
+    def __deepcopy__(self, memo):
+        # Read-only after parse, shared by every instance run
+        return self
+
+    async def invoke(self, session, variables, instance_id):
+        parameters = {
+            key: template and template.render(variables)
+            for key, template in self.parameters
+        }
+
+        # JSON data for API
+        data = {}
+        for key, kind, template in self.inputs:
+            if kind is str:
+                value = template.render(variables)
+            elif kind is list:
+                value = [t.render(variables) for t in template]
+            elif kind is dict:
+                value = {k: t and t.render(variables) for k, t in template.items()}
+            else:
+                value = template
+            # Special case for instance id
+            if key == "id_instance":
+                value = instance_id
+            data[key] = value
+        # system vars
+        data = {**data, **env.SYSTEM_VARS}
+
+        async with self.call_function(
+            session,
+            self.url.render(variables),
+            params=parameters,
+            json=data,
+        ) as response:
+            if response.status not in _OK_STATUSES:
+                raise Exception(await response.text())
+
+            # Check for output variables, 204 has no body to read them from
+            if self.output_variables and response.status != 204:
+                r = await response.json(content_type=None)
+                for key in self.output_variables:
+                    if key in r:
+                        variables[key] = r[key]
+
+
 @bpmn_tag("bpmn:serviceTask")
 class ServiceTask(Task):
+    __slots__ = (
+        "properties_fields",
+        "input_variables",
+        "output_variables",
+        "connector_fields",
+        "_compiled_call",
+    )
+
     def __init__(self):
         self.properties_fields = {}
         self.input_variables = {}
@@ -160,106 +328,105 @@ class ServiceTask(Task):
         except Exception:
             print("No DS in env.py")
 
-        for ee in element.findall(".//bpmn:extensionElements", NS):
-            # Find direct children inputOutput, Input/Output tab in Camunda
-            self._parse_input_output_variables(
-                ee, self.input_variables, self.output_variables
-            )
-            # Find connector data, Connector tab in Camunda
-            for con in ee.findall(".camunda:connector", NS):
+        # One pass over the extension children instead of a findall per tab
+        for ee in _XP_EXT_ALL(element):
+            for child in ee:
+                if child.tag == _CAMUNDA_INPUT_OUTPUT:
+                    # Input/Output tab in Camunda
+                    self._parse_input_output_variables(
+                        child, self.input_variables, self.output_variables
+                    )
+                elif child.tag == _CAMUNDA_CONNECTOR:
+                    # Connector tab in Camunda
+                    self._parse_connector(child, datasources)
+
+        self._compiled_call = self._compile_call()
+
+    def _compile_call(self):
+        connector_inputs = self.connector_fields["input_variables"]
+
+        # Plain concatenation, os.path.join would use "\\" on Windows
+        base = connector_inputs.get("base_url", "").rstrip("/")
+        tail = (connector_inputs.get("url") or "").lstrip("/")
+        url = f"{base}/{tail}" if base and tail else base or tail
+
+        url_parameter = connector_inputs.get("url_parameter")
+        if not isinstance(url_parameter, dict):
+            url_parameter = {}
+
+        return _CompiledCall(
+            # GET when method is not set
+            call_function=_HTTP_METHODS.get(
+                connector_inputs.get("method"), aiohttp.ClientSession.get
+            ),
+            url=compile_expression(url),
+            parameters=tuple(
+                (key, value and compile_expression(value))
+                for key, value in url_parameter.items()
+            ),
+            inputs=tuple(
+                (key, type(value), self._compile_input(value))
+                for key, value in self.input_variables.items()
+            ),
+            output_variables=tuple(self.output_variables),
+        )
+
+    @staticmethod
+    def _compile_input(value):
+        if isinstance(value, str):
+            return compile_expression(value)
+        if isinstance(value, list):
+            return tuple(compile_expression(v) for v in value)
+        if isinstance(value, dict):
+            # Map entries without text are sent as null
+            return {k: v and compile_expression(v) for k, v in value.items()}
+        return value
+
+    def _parse_connector(self, element, datasources):
+        connector_id = None
+        for child in element:
+            if child.tag == _CAMUNDA_INPUT_OUTPUT:
                 self._parse_input_output_variables(
-                    con,
+                    child,
                     self.connector_fields["input_variables"],
                     self.connector_fields["output_variables"],
                 )
-                connector_id = con.find("camunda:connectorId", NS).text
-                if connector_id in datasources:
-                    ds = datasources[connector_id]
-                    self.connector_fields["connector_id"] = ds["type"]
-                    self.connector_fields["input_variables"]["base_url"] = ds["url"]
+            elif child.tag == _CAMUNDA_CONNECTOR_ID:
+                connector_id = child.text
+        if connector_id in datasources:
+            ds = datasources[connector_id]
+            self.connector_fields["connector_id"] = ds["type"]
+            self.connector_fields["input_variables"]["base_url"] = ds["url"]
 
     def _parse_input_output_variables(self, element, input_dict, output_dict):
-        for io in element.findall(".camunda:inputOutput", NS):
-            for inparam in io.findall(".camunda:inputParameter", NS):
-                self._parse_input_output_parameters(inparam, input_dict)
-            for outparam in io.findall(".camunda:outputParameter", NS):
-                self._parse_input_output_parameters(outparam, output_dict)
+        for param in element:
+            if param.tag == _CAMUNDA_INPUT_PARAMETER:
+                self._parse_input_output_parameters(param, input_dict)
+            elif param.tag == _CAMUNDA_OUTPUT_PARAMETER:
+                self._parse_input_output_parameters(param, output_dict)
 
     def _parse_input_output_parameters(self, element, dictionary):
-        if element.findall(".camunda:list", NS):
-            helper_list = []
-            for lv in element.find("camunda:list", NS):
-                helper_list.append(lv.text) if lv.text else ""
-            dictionary[element.attrib["name"]] = helper_list
-        elif element.findall(".camunda:map", NS):
-            helper_dict = {}
-            for mv in element.find("camunda:map", NS):
-                helper_dict[mv.attrib["key"]] = mv.text
-            dictionary[element.attrib["name"]] = helper_dict
-        elif element.findall(".camunda:script", NS):
-            # script not supported
-            pass
-        else:
+        # Single walk for whichever value type the parameter holds
+        values = _XP_IO_VALUE(element)
+        value = values[0] if values else None
+        if value is None:
             dictionary[element.attrib["name"]] = element.text if element.text else ""
+        elif value.tag == _CAMUNDA_LIST:
+            dictionary[element.attrib["name"]] = [lv.text for lv in value if lv.text]
+        elif value.tag == _CAMUNDA_MAP:
+            dictionary[element.attrib["name"]] = {
+                mv.attrib["key"]: mv.text for mv in value
+            }
+        # script not supported
 
-    async def run_connector(self, variables, instance_id):
-        # Check for URL parameters
-        parameters = {}
-        if self.connector_fields["input_variables"].get("url_parameter"):
-            for key, value in self.connector_fields["input_variables"][
-                "url_parameter"
-            ].items():
-                # Parse expression and add to parameters
-                parameters[key] = parse_expression(value, variables)
+    def read_variables(self):
+        return self._compiled_call.read_variables
 
-        # JSON data for API
-        data = {}
-        for key, value in self.input_variables.items():
-            # Parse expression if it exists
-            if isinstance(value, str):
-                value = parse_expression(value, variables)
-            elif isinstance(value, list):
-                value = [parse_expression(v, variables) for v in value]
-            elif isinstance(value, dict):
-                for k, v in value.items():
-                    value[k] = parse_expression(v, variables)
-            # Special case for instance id
-            if key == "id_instance":
-                value = instance_id
-            # Add parsed value to data
-            data[key] = value
-        # system vars
-        data = {**data, **env.SYSTEM_VARS}
+    def written_variables(self):
+        return self._compiled_call.output_variables
 
-        url = os.path.join(
-            self.connector_fields["input_variables"].get("base_url", ""),
-            self.connector_fields["input_variables"]["url"].lstrip("/"),
-        )
-
-        # Check method and make request
-        if method := self.connector_fields["input_variables"].get("method"):
-            if method == "POST":
-                call_function = requests.post
-            elif method == "PATCH":
-                call_function = requests.patch
-            else:
-                call_function = requests.get
-
-            response = call_function(
-                url,
-                params=parameters,
-                json=data,
-            )
-
-        if response.status_code not in (200, 201):
-            raise Exception(response.text)
-
-        # Check for output variables
-        if self.output_variables:
-            r = response.json()
-            for key in self.output_variables:
-                if key in r:
-                    variables[key] = r[key]
+    async def run_connector(self, variables, instance_id):
+        await self._compiled_call.invoke(get_http_session(), variables, instance_id)
 
     async def run(self, variables, instance_id):
         if self.connector_fields["connector_id"] == "http-connector":
@@ -269,30 +436,33 @@ class ServiceTask(Task):
 
 @bpmn_tag("bpmn:sendTask")
 class SendTask(ServiceTask):
+    __slots__ = ()
+
     def parse(self, element):
         super(SendTask, self).parse(element)
 
 
 @bpmn_tag("bpmn:callActivity")
 class CallActivity(Task):
+    __slots__ = ("deployment", "called_element")
+
     def __init__(self):
         self.deployment = False
         self.called_element = ""
 
     def parse(self, element):
         super(CallActivity, self).parse(element)
-        if element.attrib.get("calledElement"):
-            self.called_element = element.attrib["calledElement"]
-        if (
-            element.attrib.get(f"{{{NS['camunda']}}}calledElementBinding")
-            and element.attrib.get(f"{{{NS['camunda']}}}calledElementBinding")
-            == "deployment"
-        ):
+        if called_element := element.get("calledElement"):
+            self.called_element = called_element
+        binding = element.get(_CAMUNDA_CALLED_ELEMENT_BINDING)
+        if binding == "deployment":
             self.deployment = True
 
 
 @bpmn_tag("bpmn:businessRule")
 class BusinessRule(ServiceTask):
+    __slots__ = ("decision_ref",)
+
     def __init__(self):
         self.decision_ref = None
 
@@ -302,29 +472,33 @@ class BusinessRule(ServiceTask):
 
 @bpmn_tag("bpmn:event")
 class Event(BpmnObject):
-    pass
+    __slots__ = ()
 
 
 @bpmn_tag("bpmn:startEvent")
 class StartEvent(Event):
-    pass
+    __slots__ = ()
 
 
 @bpmn_tag("bpmn:endEvent")
 class EndEvent(Event):
-    pass
+    __slots__ = ()
 
 
 @bpmn_tag("bpmn:gateway")
 class Gateway(BpmnObject):
+    __slots__ = ("incoming", "outgoing")
+
     def parse(self, element):
-        self.incoming = len(element.findall("bpmn:incoming", NS))
-        self.outgoing = len(element.findall("bpmn:outgoing", NS))
+        self.incoming = len(_XP_INCOMING(element))
+        self.outgoing = len(_XP_OUTGOING(element))
         super(Gateway, self).parse(element)
 
 
 @bpmn_tag("bpmn:parallelGateway")
 class ParallelGateway(Gateway):
+    __slots__ = ()
+
     def add_token(self):
         self.incoming -= 1
 
@@ -334,12 +508,17 @@ class ParallelGateway(Gateway):
 
 @bpmn_tag("bpmn:exclusiveGateway")
 class ExclusiveGateway(Gateway):
+    __slots__ = ("default",)
+
     def __init__(self):
         self.default = False
         super(ExclusiveGateway, self).__init__()
 
     def parse(self, element):
-        self.default = (
-            element.attrib["default"] if "default" in element.attrib else None
-        )
+        self.default = element.get("default")
         super(ExclusiveGateway, self).parse(element)
+
+
+# Registered classes keyed by the Clark notation tags lxml reports, so the
+# model loader can dispatch on element.tag without rebuilding the prefix
+BPMN_MAPPINGS_QN = {_qname(tag): _type for tag, _type in BPMN_MAPPINGS.items()}
@@ -1,10 +1,16 @@
 from pony.orm import *
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+import asyncio
 import env
 import os
 
 DB = Database()
 
+# Queries block, so the engine and server run them off the event loop
+_executor = ThreadPoolExecutor(max_workers=8)
+
 
 class Event(DB.Entity):
     model_name = Required(str)
@@ -40,6 +46,11 @@ def setup_db(provider=None, recreate=False):
         DB.create_tables()
 
 
+async def run_async(function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(function, *args, **kwargs))
+
+
 @db_session
 def add_event(
     model_name, instance_id, activity_id, timestamp, pending, activity_variables
@@ -65,6 +76,22 @@ def finish_running_instance(instance):
     finished_instance.running = False
 
 
+def _get_events(instance_id):
+    model_path = None
+    events = Event.select(lambda e: e.instance_id == instance_id).order_by(
+        Event.timestamp
+    )[:]
+    events_list = []
+    for event in events:
+        model_path = event.model_name
+        event_dict = {}
+        event_dict["activity_id"] = event.activity_id
+        event_dict["pending"] = event.pending
+        event_dict["activity_variables"] = event.activity_variables
+        events_list.append(event_dict)
+    return model_path, events_list
+
+
 @db_session
 def get_running_instances_log():
     log = []
@@ -72,20 +99,23 @@ def get_running_instances_log():
     for instance in running_instances:
         instance_dict = {}
         instance_dict[instance.instance_id] = {}
-        events = Event.select(lambda e: e.instance_id == instance.instance_id).order_by(
-            Event.timestamp
-        )[:]
-        events_list = []
-        for event in events:
-            model_path = event.model_name
-            event_dict = {}
-            event_dict["activity_id"] = event.activity_id
-            event_dict["pending"] = event.pending
-            event_dict["activity_variables"] = event.activity_variables
-            events_list.append(event_dict)
+        model_path, events_list = _get_events(instance.instance_id)
 
         instance_dict[instance.instance_id]["model_path"] = model_path
         instance_dict[instance.instance_id]["events"] = events_list
         log.append(instance_dict)
 
     return log
+
+
+@db_session
+def get_instance_log(instance_id):
+    model_path, events_list = _get_events(instance_id)
+    if model_path is None:
+        return None
+    running_instance = RunningInstance.get(instance_id=instance_id)
+    return {
+        "model_path": model_path,
+        "events": events_list,
+        "running": bool(running_instance and running_instance.running),
+    }
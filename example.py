@@ -1,5 +1,6 @@
 import asyncio
 from bpmn_model import BpmnModel, UserFormMessage
+from bpmn_types import close_http_session
 from db_connector import setup_db
 import random
 
@@ -71,6 +72,7 @@ def run_serial():
         for i, p in enumerate(instances):
             print(f"Running process {i+1}\n-----------------")
             await asyncio.gather(simulate_user(p.in_queue), p.run())
+        await close_http_session()
 
     asyncio.run(serial())
 
@@ -81,6 +83,7 @@ def run_parallel():
         users = [simulate_user(i.in_queue) for i in instances]
         processes = [p.run() for p in instances]
         await asyncio.gather(*users, *processes)
+        await close_http_session()
 
     print(f"Running processes\n-----------------")
     asyncio.run(parallel())
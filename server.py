@@ -3,17 +3,23 @@ import os
 from aiohttp import web
 from uuid import uuid4
 import asyncio
-from bpmn_model import BpmnModel, UserFormMessage, get_model_for_instance
+from bpmn_model import (
+    BpmnModel,
+    UserFormMessage,
+    all_instances,
+    search_instances,
+)
+from bpmn_types import HTTP_TIMEOUT, set_http_session
 import aiohttp_cors
+import orjson
 import db_connector
-from functools import reduce
+from weakref import WeakValueDictionary
+from collections import OrderedDict
 
 # Setup database
 db_connector.setup_db()
 routes = web.RouteTableDef()
 
-# uuid4 = lambda: 2  # hardcoded for easy testing
-
 models = {}
 for file in os.listdir("models"):
     if file.endswith(".bpmn"):
@@ -23,7 +29,15 @@ for file in os.listdir("models"):
 
 async def run_as_server(app):
     app["bpmn_models"] = models
-    log = db_connector.get_running_instances_log()
+    # One pooled session for all connector calls made by service tasks
+    app["http_session"] = aiohttp.ClientSession(
+        timeout=HTTP_TIMEOUT,
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+        # Connector request bodies go through orjson too
+        json_serialize=lambda data: orjson.dumps(data).decode(),
+    )
+    set_http_session(app["http_session"])
+    log = await db_connector.run_async(db_connector.get_running_instances_log)
     for l in log:
         for key, data in l.items():
             if data["model_path"] in app["bpmn_models"]:
@@ -31,18 +45,71 @@ async def run_as_server(app):
                     key, {}
                 )
                 instance = await instance.run_from_log(data["events"])
-                asyncio.create_task(instance.run())
+                instance.start()
+
+
+# One lock per instance id being restored, so concurrent requests for the
+# same cold instance replay its log only once
+instance_locks = WeakValueDictionary()
+# Strong references to the most recently restored instances, so repeated
+# reads of a finished instance do not replay its log every time
+restored_instances = OrderedDict()
+RESTORED_INSTANCES_SIZE = 128
+
+
+async def get_instance(instance_id):
+    # Running instances are held by their tasks, recently restored ones by
+    # restored_instances. Anything else is replayed from the event log
+    instance = all_instances.get(instance_id)
+    if instance:
+        if instance_id in restored_instances:
+            restored_instances.move_to_end(instance_id)
+        return instance
+
+    lock = instance_locks.get(instance_id)
+    if lock is None:
+        lock = instance_locks[instance_id] = asyncio.Lock()
+    async with lock:
+        # Another request may have restored it while we waited
+        instance = all_instances.get(instance_id)
+        if instance:
+            return instance
+
+        data = await db_connector.run_async(db_connector.get_instance_log, instance_id)
+        if not data or data["model_path"] not in models:
+            return None
+        instance = await models[data["model_path"]].create_instance(instance_id, {})
+        instance = await instance.run_from_log(data["events"])
+        # Read-only restore: engines are resumed only by run_as_server
+        if not data["running"]:
+            instance.state = "finished"
+            instance.pending = []
+        restored_instances[instance_id] = instance
+        if len(restored_instances) > RESTORED_INSTANCES_SIZE:
+            restored_instances.popitem(last=False)
+        return instance
+
+
+def json_response(data, status=200):
+    # orjson serializes in C, much faster than json.dumps for instance payloads
+    return web.Response(
+        body=orjson.dumps(data), status=status, content_type="application/json"
+    )
+
+
+async def close_http_session(app):
+    await app["http_session"].close()
 
 
 @routes.get("/model")
 async def get_models(request):
     data = [m.to_json() for m in models.values()]
-    return web.json_response({"status": "ok", "results": data})
+    return json_response({"status": "ok", "results": data})
 
 
 @routes.get("/model/{model_name}")
 async def get_model(request):
-    model_name = request.match_info.get("model_name")
+    model_name = request.match_info["model_name"]
     return web.FileResponse(
         path=os.path.join("models", app["bpmn_models"][model_name].model_path)
     )
@@ -50,97 +117,72 @@ async def get_model(request):
 
 @routes.post("/model/{model_name}/instance")
 async def handle_new_instance(request):
-    _id = str(uuid4())
-    model = request.match_info.get("model_name")
+    _id = uuid4().hex
+    model = request.match_info["model_name"]
     instance = await app["bpmn_models"][model].create_instance(_id, {})
-    asyncio.create_task(instance.run())
-    return web.json_response({"id": _id})
+    instance.start()
+    return json_response({"id": _id})
 
 
 @routes.post("/instance/{instance_id}/task/{task_id}/form")
 async def handle_form(request):
     post = await request.json()
-    instance_id = request.match_info.get("instance_id")
-    task_id = request.match_info.get("task_id")
-    m = get_model_for_instance(instance_id)
-    m.instances[instance_id].in_queue.put_nowait(UserFormMessage(task_id, post))
+    match_info = request.match_info
+    instance_id = match_info["instance_id"]
+    task_id = match_info["task_id"]
+    instance = await get_instance(instance_id)
+    if not instance:
+        raise aiohttp.web.HTTPNotFound
+    instance.in_queue.put_nowait(UserFormMessage(task_id, post))
 
-    return web.json_response({"status": "OK"})
+    return json_response({"status": "OK"})
 
 
 @routes.get("/instance")
 async def search_instance(request):
     params = request.rel_url.query
-    queries = []
-    try:
-        strip_lower = lambda x: x.strip().lower()
-        check_colon = lambda x: x if ":" in x else f":{x}"
-
-        queries = list(
-            tuple(
-                map(
-                    strip_lower,
-                    check_colon(q).split(":"),
-                )
-            )
-            for q in params["q"].split(",")
-        )
-    except:
-        return web.json_response({"error": "invalid_query"}, status=400)
-
-    result_ids = []
-    for (att, value) in queries:
-        ids = []
-        for m in models.values():
-            for _id, instance in m.instances.items():
-                search_atts = []
-                if not att:
-                    search_atts = list(instance.variables.keys())
-                else:
-                    for key in instance.variables.keys():
-                        if not att or att in key.lower():
-                            search_atts.append(key)
-                search_atts = filter(
-                    lambda x: isinstance(instance.variables[x], str), search_atts
-                )
-
-                for search_att in search_atts:
-                    if search_att and value in instance.variables[search_att].lower():
-                        # data.append(instance.to_json())
-                        ids.append(_id)
-        result_ids.append(set(ids))
+    if "q" not in params:
+        return json_response({"error": "invalid_query"}, status=400)
 
-    ids = reduce(lambda a, x: a.intersection(x), result_ids[:-1], result_ids[0])
+    queries = []
+    for term in params["q"].split(","):
+        # "value" searches all variables, "att:value" only matching names
+        att, colon, value = term.partition(":")
+        if not colon:
+            att, value = "", att
+        queries.append((att.strip().lower(), value.strip().lower()))
 
     data = []
-    for _id in ids:
-        data.append(get_model_for_instance(_id).instances[_id].to_json())
+    for instance_id in search_instances(queries):
+        # Finished instances may have been collected, restore them
+        instance = await get_instance(instance_id)
+        if instance:
+            data.append(instance.to_json())
 
-    return web.json_response({"status": "ok", "results": data})
+    return json_response({"status": "ok", "results": data})
 
 
 @routes.get("/instance/{instance_id}/task/{task_id}")
 async def handle_task_info(request):
-    instance_id = request.match_info.get("instance_id")
-    task_id = request.match_info.get("task_id")
-    m = get_model_for_instance(instance_id)
-    if not m:
+    match_info = request.match_info
+    instance_id = match_info["instance_id"]
+    task_id = match_info["task_id"]
+    instance = await get_instance(instance_id)
+    if not instance:
         raise aiohttp.web.HTTPNotFound
-    instance = m.instances[instance_id]
     task = instance.model.elements[task_id]
 
-    return web.json_response(task.get_info())
+    return json_response(task.get_info())
 
 
 @routes.get("/instance/{instance_id}")
 async def handle_instance_info(request):
-    instance_id = request.match_info.get("instance_id")
-    m = get_model_for_instance(instance_id)
-    if not m:
+    instance_id = request.match_info["instance_id"]
+    instance = await get_instance(instance_id)
+    if not instance:
         raise aiohttp.web.HTTPNotFound
-    instance = m.instances[instance_id].to_json()
 
-    return web.json_response(instance)
+    return json_response(instance.to_json())
 
 
 app = None
@@ -150,6 +192,7 @@ def run():
     global app
     app = web.Application()
     app.on_startup.append(run_as_server)
+    app.on_cleanup.append(close_http_session)
     app.add_routes(routes)
 
     cors = aiohttp_cors.setup(
@@ -175,5 +218,12 @@ async def serve():
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+
+        # Faster drop-in event loop, not available on Windows
+        uvloop.install()
+    except ImportError:
+        pass
     app = run()
     web.run_app(app, port=9000)
@@ -1,13 +1,60 @@
-class SafeDict(dict):
-    def __missing__(self, key):
+from functools import lru_cache
+from string import Formatter
+
+
+class SafeLookup:
+    # Leaves unknown ${keys} as they are, without copying the variables
+    __slots__ = ("variables",)
+
+    def __init__(self, variables):
+        self.variables = variables
+
+    def __getitem__(self, key):
+        if key in self.variables:
+            return self.variables[key]
         return "${" + key + "}"
 
 
-def parse_expression(expression, process_variables):
-    if (key := expression.replace("${", "").replace("}", "")) in process_variables:
-        return process_variables[key]
+class Expression:
+    def __init__(self, expression):
+        self.expression = expression
+        self.key = expression.replace("${", "").replace("}", "")
+        self.template = expression.replace("${", "{")
+        # Nothing to substitute, render() only has to check for the key
+        self.is_literal = "{" not in self.template and "}" not in self.template
+        # Every variable render() can read: the whole key and each ${name}
+        self.variables = frozenset({self.key, *self._field_names(self.template)})
+
+    @staticmethod
+    def _field_names(template):
+        try:
+            fields = [field for _, field, _, _ in Formatter().parse(template) if field]
+        except ValueError:
+            # Malformed, render() can then only succeed through the key
+            return ()
+        return (field.split("[")[0].split(".")[0] for field in fields)
+
+    def __deepcopy__(self, memo):
+        # Immutable and shared through the compile cache
+        return self
 
-    return expression.replace("${", "{").format_map(SafeDict(process_variables))
+    def render(self, process_variables):
+        if self.key in process_variables:
+            return process_variables[self.key]
+        if self.is_literal:
+            return self.template
+
+        return self.template.format_map(SafeLookup(process_variables))
+
+
+@lru_cache(maxsize=4096)
+def compile_expression(expression):
+    # Cached on the raw expression only, variables are passed to render()
+    return Expression(expression)
+
+
+def parse_expression(expression, process_variables):
+    return compile_expression(expression).render(process_variables)
 
 
 if __name__ == "__main__":